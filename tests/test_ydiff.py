@@ -8,6 +8,7 @@ import unittest
 import tempfile
 import subprocess
 import os
+import difflib
 
 sys.path.insert(0, '')
 import ydiff  # nopep8
@@ -68,6 +69,40 @@ class PatchStreamTest(unittest.TestCase):
         self.assertEqual(out, items)
 
 
+class Broken(Sequential):
+    """Mock of file object which fails to read after given items"""
+
+    def __iter__(self):
+        while self._index < len(self._items):
+            yield self._items[self._index]
+            self._index += 1
+        raise IOError('read error')
+
+
+class PatchStreamForwarderTest(unittest.TestCase):
+
+    def _forward(self, diff_hdl):
+        translator = subprocess.Popen(['cat'], stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE)
+        stream = ydiff.PatchStream(diff_hdl)
+        stream.read_stream_header(2)
+        forwarder = ydiff.PatchStreamForwarder(stream, translator)
+        try:
+            return list(forwarder)
+        finally:
+            translator.stdout.close()
+            translator.wait()
+
+    def test_forward(self):
+        items = [('line %d\n' % i).encode('ascii') for i in range(10000)]
+        self.assertEqual(self._forward(Sequential(items)), items)
+
+    def test_forward_read_error(self):
+        items = ['hello\n'.encode('ascii'), 'world\n'.encode('ascii'),
+                 'again\n'.encode('ascii')]
+        self.assertRaises(IOError, self._forward, Broken(items))
+
+
 class DecodeTest(unittest.TestCase):
 
     def test_normal(self):
@@ -82,6 +117,35 @@ class DecodeTest(unittest.TestCase):
             decoded_text = text
         self.assertEqual(decoded_text, ydiff.decode(text))
 
+    def test_latin_1_bytes(self):
+        btext = u'caf\xe9\n'.encode('latin1')
+        self.assertEqual(u'caf\xe9\n', ydiff.decode(btext))
+
+
+class StrSplitTest(unittest.TestCase):
+
+    def test_not_colorized(self):
+        text = 'Hi, ymattw!'
+        self.assertEqual(ydiff.strsplit(text, 4), ('Hi, ', 'ymattw!', 4))
+        self.assertEqual(ydiff.strsplit(text, 11), (text, '', 11))
+        self.assertEqual(ydiff.strsplit(text, 20), (text, '', 11))
+
+    def test_colorized(self):
+        text = '\x1b[31mHi, \x1b[0m\x1b[33mymattw!\x1b[0m'
+        self.assertEqual(ydiff.strsplit(text, 4),
+                         ('\x1b[31mHi, \x1b[0m\x1b[33m\x1b[0m',
+                          '\x1b[33mymattw!\x1b[0m', 4))
+        self.assertEqual(ydiff.strsplit(text, 3),
+                         ('\x1b[31mHi,\x1b[0m',
+                          '\x1b[31m \x1b[0m\x1b[33mymattw!\x1b[0m', 3))
+        self.assertEqual(ydiff.strsplit(text, 11), (text, '', 11))
+
+    def test_stacked_colors(self):
+        text = '\x1b[7m\x1b[31mfoobar'
+        self.assertEqual(ydiff.strsplit(text, 3),
+                         ('\x1b[7m\x1b[31mfoo\x1b[0m',
+                          '\x1b[31m\x1b[7mbar', 3))
+
 
 class HunkTest(unittest.TestCase):
 
@@ -99,6 +163,96 @@ class HunkTest(unittest.TestCase):
         hunk.append((' ', 'common\n'))
         self.assertEqual(hunk._get_new_text(), ['bar\n', 'common\n'])
 
+    def test_is_completed(self):
+        hunk = ydiff.Hunk([], '@@ -1,2 +1,2 @@', (1, 2), (1, 2))
+        hunk.append(('-', 'foo\n'))
+        hunk.append(('+', 'bar\n'))
+        self.assertFalse(hunk.is_completed())
+        hunk.append((' ', 'common\n'))
+        self.assertTrue(hunk.is_completed())
+
+    def test_mdiff_by_run(self):
+        # No line of a changed run is identical to a common line, so the
+        # alignment is the same as difflib on whole hunk, see
+        # test_mdiff_by_run_alignment() for when it's not
+        hunk = ydiff.Hunk([], '@@ -1,4 +1,4 @@', (1, 4), (1, 4))
+        hunk.append(('-', 'hhello\n'))
+        hunk.append(('+', 'helloo\n'))
+        hunk.append(('+', 'spammm\n'))
+        hunk.append((' ', 'world\n'))
+        hunk.append(('-', 'garb\n'))
+        hunk.append(('-', 'Again\n'))
+        hunk.append(('+', 'again\n'))
+        expected = list(difflib._mdiff(hunk._get_old_text(),
+                                       hunk._get_new_text()))
+        self.assertEqual(list(hunk._mdiff_by_run()), expected)
+
+    def test_mdiff_by_run_alignment(self):
+        # Whole hunk difflib matches the deleted blank line with the common
+        # one and marks the latter as deleted, diffing by run keeps the
+        # alignment of the patch
+        hunk = ydiff.Hunk([], '@@ -1,4 +1,3 @@', (1, 4), (1, 3))
+        hunk.append((' ', 'foo\n'))
+        hunk.append(('-', '\n'))
+        hunk.append((' ', '\n'))
+        hunk.append((' ', 'bar\n'))
+        whole = list(difflib._mdiff(hunk._get_old_text(),
+                                    hunk._get_new_text()))
+        self.assertEqual(whole[1], ((2, '\n'), (2, '\n'), False))
+        self.assertEqual(whole[2], ((3, '\x00-\n\x01'), ('', '\n'), True))
+
+        out = list(hunk._mdiff_by_run())
+        self.assertEqual(out, [
+            ((1, 'foo\n'), (1, 'foo\n'), False),
+            ((2, '\x00-\n\x01'), ('', '\n'), True),
+            ((3, '\n'), (2, '\n'), False),
+            ((4, 'bar\n'), (3, 'bar\n'), False),
+        ])
+
+    def test_mdiff_one_side(self):
+        hunk = ydiff.Hunk([], '@@ -0,0 +1,2 @@', (0, 0), (1, 2))
+        hunk.append(('+', 'foo\n'))
+        hunk.append(('+', '\n'))
+        expected = list(difflib._mdiff([], hunk._get_new_text()))
+        self.assertEqual(list(hunk.mdiff()), expected)
+
+        hunk = ydiff.Hunk([], '@@ -1,2 +0,0 @@', (1, 2), (0, 0))
+        hunk.append(('-', 'foo\n'))
+        hunk.append(('-', '\n'))
+        expected = list(difflib._mdiff(hunk._get_old_text(), []))
+        self.assertEqual(list(hunk.mdiff()), expected)
+
+    def test_mdiff_no_inline(self):
+        hunk = ydiff.Hunk([], '@@ -1,3 +1,3 @@', (1, 3), (1, 3))
+        hunk.append(('-', 'hhello\n'))
+        hunk.append(('-', 'spam\n'))
+        hunk.append(('+', 'helloo\n'))
+        hunk.append((' ', 'world\n'))
+        hunk.append(('+', 'again\n'))
+        out = list(hunk.mdiff(inline=False))
+        self.assertEqual(out, [
+            ((1, 'hhello\n'), (1, 'helloo\n'), True),
+            ((2, '\x00-spam\n\x01'), ('', '\n'), True),
+            ((3, 'world\n'), (2, 'world\n'), False),
+            (('', '\n'), (3, '\x00+again\n\x01'), True),
+        ])
+
+    @unittest.skipIf(ydiff.Hunk._get_dmp() is None,
+                     'diff_match_patch is not installed')
+    def test_mdiff_long_line(self):
+        head = 'x' * ydiff.Hunk.LONG_LINE_LEN
+        hunk = ydiff.Hunk([], '@@ -1,3 +1,2 @@', (1, 3), (1, 2))
+        hunk.append(('-', head + 'foo\n'))
+        hunk.append(('-', 'spam\n'))
+        hunk.append(('+', head + 'bar baz\n'))
+        hunk.append((' ', 'common\n'))
+        out = list(hunk.mdiff())
+        self.assertEqual(len(out), 3)
+        self.assertEqual(out[0], ((1, head + '\x00^foo\x01\n'),
+                                  (1, head + '\x00^bar baz\x01\n'), True))
+        self.assertEqual(out[1], ((2, '\x00-spam\n\x01'), ('', '\n'), True))
+        self.assertEqual(out[2], ((3, 'common\n'), (2, 'common\n'), False))
+
 
 class DiffMarkupTest(unittest.TestCase):
 
@@ -200,6 +354,19 @@ class DiffMarkupTest(unittest.TestCase):
             '\x1b[4m\x1b[32mo\x1b[0m\x1b[32m\n\x1b[0m')
         self.assertEqual(out[5], '\x1b[0m common\n\x1b[0m')
 
+    def test_markup_traditional_no_inline(self):
+        hunk = ydiff.Hunk([], '@@ -1 +1 @@\n', (1, 1), (1, 1))
+        hunk.append(('-', 'hella\n'))
+        hunk.append(('+', 'hello\n'))
+        diff = ydiff.UnifiedDiff([], '--- old\n', '+++ new\n', [hunk])
+        marker = ydiff.DiffMarker(inline=False)
+
+        out = list(marker.markup(diff))
+        self.assertEqual(len(out), 5)
+
+        self.assertEqual(out[3], '\x1b[1;31m-\x1b[0m\x1b[31mhella\n\x1b[0m')
+        self.assertEqual(out[4], '\x1b[32m+\x1b[0m\x1b[32mhello\n\x1b[0m')
+
     def test_markup_side_by_side_padded(self):
         diff = self._init_diff()
         marker = ydiff.DiffMarker(side_by_side=True, width=7)
@@ -479,6 +646,10 @@ class UnifiedDiffTest(unittest.TestCase):
     def test_parse_hunk_meta_normal(self):
         self.assertEqual(self.diff.parse_hunk_meta('@@ -3,7 +3,6 @@'),
                          ((3, 7), (3, 6)))
+        self.assertEqual(self.diff.parse_hunk_meta('@@ -1 +1  @@'),
+                         ((1, 1), (1, 1)))
+        self.assertEqual(self.diff.parse_hunk_meta('@@ -3,7\t+3,6 @@ foo\n'),
+                         ((3, 7), (3, 6)))
 
     def test_parse_hunk_meta_missing(self):
         self.assertEqual(self.diff.parse_hunk_meta('@@ -3 +3,6 @@'),
@@ -492,6 +663,12 @@ class UnifiedDiffTest(unittest.TestCase):
         self.assertEqual(self.diff.parse_hunk_meta('## -0,0 +1 ##'),
                          ((0, 0), (1, 1)))
 
+    def test_parse_hunk_meta_neg(self):
+        self.assertRaises(ValueError, self.diff.parse_hunk_meta,
+                          '@@ -a,a +0 @@')
+        self.assertRaises(ValueError, self.diff.parse_hunk_meta,
+                          '@@ -1,2 1,2 @@')
+
     def test_is_old(self):
         self.assertTrue(self.diff.is_old('-hello world'))
         self.assertTrue(self.diff.is_old('----'))            # yaml
@@ -801,6 +978,11 @@ class MainTest(unittest.TestCase):
                'cd %s; git add foo; git commit foo -m update' % self._ws]
         subprocess.call(cmd, stdout=subprocess.PIPE)
 
+    def test_default_options(self):
+        defaults = ydiff._build_parser().get_default_values()
+        for name, value in vars(defaults).items():
+            self.assertEqual(getattr(ydiff._DefaultOptions, name), value)
+
     def test_preset_options(self):
         os.environ['YDIFF_OPTIONS'] = '--help'
         self.assertRaises(SystemExit, ydiff.main)
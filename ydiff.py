@@ -10,10 +10,10 @@ python (>= 2.5.0) and ``less``.
 import sys
 import os
 import re
+import errno
 import signal
 import subprocess
-import select
-import difflib
+import threading
 
 META_INFO = {
     'version'     : '1.1',
@@ -59,6 +59,13 @@ COLORS = {
     'lightcyan'     : '\x1b[1;36m',
 }
 
+# Matches any of above escape sequences
+_COLORS_RE = re.compile('|'.join([re.escape(c) for c in COLORS.values()]))
+
+# Matches markers inserted by difflib._mdiff(), see Hunk.mdiff()
+_MARKER_RE = re.compile(r'(\x00[+^-]|\x01)')
+_MARKER_CODES = {}
+
 # Keys for revision control probe, diff and log (optional) with diff
 VCS_INFO = {
     'Git': {
@@ -83,6 +90,23 @@ VCS_INFO = {
     },
 }
 
+# For error message when not in a workspace
+_SUPPORTED_VCS = ', '.join(sorted(VCS_INFO))
+
+# Messages main() writes to stderr
+_ERR_CDIFF_DEPRECATED = ('*** CDIFF_OPTIONS will be deprecated soon, please '
+                         'use YDIFF_OPTIONS instead\n')
+_ERR_NOT_IN_WORKSPACE = ('*** Not in a supported workspace, supported are: '
+                         '%s\n' % _SUPPORTED_VCS)
+_ERR_NO_LOG_FMT = '*** %s does not support log command.\n'
+
+# Size of chunks to write output in
+IO_CHUNK_SIZE = 65536
+
+# Capacity requested for the pipe reading from revision control, see
+# vcs_popen()
+PIPE_SIZE = 1 << 20
+
 
 def revision_control_probe():
     """Returns version control name (key in VCS_INFO) or None."""
@@ -91,23 +115,57 @@ def revision_control_probe():
             return vcs_name
 
 
+def vcs_popen(cmd):
+    """Runs revision control command and returns its buffered stdout.  On Linux
+    the pipe is enlarged as well so that the command isn't blocked every 64KB
+    while ydiff is busy rendering.
+    """
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            bufsize=IO_CHUNK_SIZE)
+    if sys.platform.startswith('linux'):
+        try:
+            import fcntl
+            # F_SETPIPE_SZ, only exposed by fcntl module since python 3.10
+            fcntl.fcntl(proc.stdout.fileno(),
+                        getattr(fcntl, 'F_SETPIPE_SZ', 1031), PIPE_SIZE)
+        except (ImportError, IOError, OSError):
+            pass
+    return proc.stdout
+
+
 def revision_control_diff(vcs_name, args):
     """Return diff from revision control system."""
     cmd = VCS_INFO[vcs_name]['diff']
-    return subprocess.Popen(cmd + args, stdout=subprocess.PIPE).stdout
+    return vcs_popen(cmd + args)
 
 
 def revision_control_log(vcs_name, args):
     """Return log from revision control system or None."""
     cmd = VCS_INFO[vcs_name].get('log')
     if cmd is not None:
-        return subprocess.Popen(cmd + args, stdout=subprocess.PIPE).stdout
+        return vcs_popen(cmd + args)
 
 
 def colorize(text, start_color, end_color='reset'):
     return COLORS[start_color] + text + COLORS[end_color]
 
 
+def marker_codes(base_color):
+    """Returns a dict maps the markers inserted by difflib._mdiff() to the
+    escape sequences used to highlight on top of base_color, cached
+    """
+    codes = _MARKER_CODES.get(base_color)
+    if codes is None:
+        codes = {
+            '\x00-': COLORS['reverse'] + COLORS[base_color],   # del
+            '\x00+': COLORS['reverse'] + COLORS[base_color],   # add
+            '\x00^': COLORS['underline'] + COLORS[base_color],  # change
+            '\x01': COLORS['reset'] + COLORS[base_color],      # reset
+        }
+        _MARKER_CODES[base_color] = codes
+    return codes
+
+
 def strsplit(text, width):
     r"""strsplit() splits a given string into two substrings, respecting the
     escape sequences (in a global var COLORS).
@@ -119,45 +177,39 @@ def strsplit(text, width):
     appended with the resetting sequence, and the second string is prefixed
     with all active colors.
     """
-    first = ''
-    second = ''
+    # The first string is always a prefix of text, so just walk an index
+    # through it and slice once at the end
     found_colors = []
     chars_cnt = 0
     bytes_cnt = 0
-    while text:
-        # First of all, check if current string begins with any escape
-        # sequence.
-        append_len = 0
-        for color in COLORS:
-            if text.startswith(COLORS[color]):
-                if color == 'reset':
-                    found_colors = []
-                else:
-                    found_colors.append(color)
-                append_len = len(COLORS[color])
-                break
-
-        if append_len == 0:
-            # Current string does not start with any escape sequence, so,
-            # either add one more visible char to the "first" string, or
-            # break if that string is already large enough.
-            if chars_cnt >= width:
-                break
-            chars_cnt += 1
-            append_len = 1
+    for match in _COLORS_RE.finditer(text):
+        # Take visible chars before the escape sequence, break if the "first"
+        # string is already large enough.
+        append_len = max(min(match.start() - bytes_cnt, width - chars_cnt), 0)
+        chars_cnt += append_len
+        bytes_cnt += append_len
+        if bytes_cnt < match.start():
+            break
 
-        first += text[:append_len]
-        text = text[append_len:]
+        color = match.group()
+        if color == COLORS['reset']:
+            found_colors = []
+        else:
+            found_colors.append(color)
+        bytes_cnt = match.end()
+    else:
+        append_len = max(min(len(text) - bytes_cnt, width - chars_cnt), 0)
+        chars_cnt += append_len
         bytes_cnt += append_len
 
-    second = text
+    first = text[:bytes_cnt]
+    second = text[bytes_cnt:]
 
     # If the first string has some active colors at the splitting point,
     # reset it and append the same colors to the second string
     if found_colors:
         first += COLORS['reset']
-        for color in found_colors:
-            second = COLORS[color] + second
+        second = ''.join(reversed(found_colors)) + second
 
     return (first, second, chars_cnt)
 
@@ -180,22 +232,110 @@ def strtrim(text, width, wrap_char, pad):
     return text
 
 
+def _import_mdiff():
+    """Imports difflib on first use as many diffs never need it, returns
+    difflib._mdiff()
+    """
+    import difflib
+
+    # Optional C-accelerated SequenceMatcher, difflib._mdiff() looks up the
+    # global name with each call so it picks up the replacement
+    try:
+        from cdifflib import CSequenceMatcher
+        difflib.SequenceMatcher = CSequenceMatcher
+    except ImportError:
+        pass
+    return difflib._mdiff
+
+
+def _import_dmp():
+    """Imports optional diff_match_patch on first use as only very long lines
+    need it, returns the diff_match_patch class or None if not installed
+    """
+    try:
+        from diff_match_patch import diff_match_patch
+    except ImportError:
+        return None
+    return diff_match_patch
+
+
+def _mark_line(key, text):
+    """Marks whole line as added ('+') or deleted ('-') like difflib._mdiff()
+    does for line without counterpart
+    """
+    return '\x00' + key + (text or ' ') + '\x01'
+
+
+def _dmp_markup(dmp, old, new):
+    """Diffs two lines with diff_match_patch and returns them with the same
+    markers as difflib._mdiff() inserted, a deletion followed by an insertion
+    is marked as change
+    """
+    diffs = dmp.diff_main(old, new, False)
+    dmp.diff_cleanupSemantic(diffs)
+
+    old_out, new_out = [], []
+    i = 0
+    while i < len(diffs):
+        op, text = diffs[i]
+        if op == dmp.DIFF_EQUAL:
+            old_out.append(text)
+            new_out.append(text)
+        elif (op == dmp.DIFF_DELETE and i + 1 < len(diffs) and
+              diffs[i + 1][0] == dmp.DIFF_INSERT):
+            old_out.append('\x00^' + text + '\x01')
+            new_out.append('\x00^' + diffs[i + 1][1] + '\x01')
+            i += 1
+        elif op == dmp.DIFF_DELETE:
+            old_out.append('\x00-' + text + '\x01')
+        else:
+            new_out.append('\x00+' + text + '\x01')
+        i += 1
+    return (''.join(old_out), ''.join(new_out))
+
+
 class Hunk(object):
 
+    # Changed lines longer than this are diffed with diff_match_patch when it's
+    # available
+    LONG_LINE_LEN = 200
+
+    # difflib._mdiff(), imported on first use
+    _mdiff = None
+
+    # diff_match_patch class, used to find changes within very long lines
+    # where difflib is too slow (e.g. minified javascript or json), False
+    # until looked up, None if not installed
+    _dmp = False
+
+    @staticmethod
+    def _get_dmp():
+        """Returns diff_match_patch class or None, imported on first call"""
+        if Hunk._dmp is False:
+            Hunk._dmp = _import_dmp()
+        return Hunk._dmp
+
     def __init__(self, hunk_headers, hunk_meta, old_addr, new_addr):
         self._hunk_headers = hunk_headers
         self._hunk_meta = hunk_meta
         self._old_addr = old_addr   # tuple (start, offset)
         self._new_addr = new_addr   # tuple (start, offset)
         self._hunk_list = []        # list of tuple (attr, line)
+        self._old_text = []         # list of old or common lines
+        self._new_text = []         # list of new or common lines
 
     def append(self, hunk_line):
         """hunk_line is a 2-element tuple: (attr, text), where attr is:
                 '-': old, '+': new, ' ': common
         """
         self._hunk_list.append(hunk_line)
+        attr, line = hunk_line
+        if attr != '+':
+            self._old_text.append(line)
+        if attr != '-':
+            self._new_text.append(line)
 
-    def mdiff(self):
+    def mdiff(self, inline=True):
         r"""The difflib._mdiff() function returns an interator which returns a
         tuple: (from line tuple, to line tuple, boolean flag)
 
@@ -209,23 +349,140 @@ class Hunk(object):
 
         boolean flag -- None indicates context separation, True indicates
             either "from" or "to" line contains a change, otherwise False.
+
+        With inline False, changes within lines are not looked for and no
+        markers are inserted in changed lines which are paired in order.
+
+        Note difflib._mdiff() on whole hunk may align a deleted or added line
+        against an identical common line elsewhere in the hunk.  Hunks having
+        a long line when diff_match_patch is installed, and all hunks with
+        inline False, are instead rendered run by run, see _mdiff_by_run(), so
+        lines are aligned the way the patch has them.
         """
-        return difflib._mdiff(self._get_old_text(), self._get_new_text())
+        old_text = self._get_old_text()
+        new_text = self._get_new_text()
+        if not old_text or not new_text:
+            # Pure addition or deletion (e.g. new or removed file), nothing to
+            # match so no need to construct a SequenceMatcher
+            return self._mdiff_one_side(old_text, new_text)
+        if not inline:
+            return self._mdiff_by_run(inline=False)
+        # Rendering other hunks run by run as well would be cheaper but would
+        # change the alignment explained above for most diffs, so only do it
+        # where whole hunk difflib is too slow
+        if not self._has_long_line() or Hunk._get_dmp() is None:
+            return self._difflib_mdiff(old_text, new_text)
+        return self._mdiff_by_run()
+
+    def _difflib_mdiff(self, old, new):
+        if Hunk._mdiff is None:
+            Hunk._mdiff = staticmethod(_import_mdiff())
+        return self._mdiff(old, new)
+
+    def _mdiff_one_side(self, old, new):
+        """Same as difflib._mdiff() when either old or new is empty"""
+        blank = ('', '\n')
+        for (i, line) in enumerate(old):
+            yield ((i + 1, _mark_line('-', line)), blank, True)
+        for (i, line) in enumerate(new):
+            yield (blank, (i + 1, _mark_line('+', line)), True)
+
+    def _has_long_line(self):
+        for (attr, line) in self._hunk_list:
+            if attr != ' ' and len(line) > self.LONG_LINE_LEN:
+                return True
+        return False
+
+    def _get_runs(self):
+        """Splits hunk list into runs of common or changed lines, yields tuple
+        (old lines, new lines, changed)
+        """
+        old, new, changed = [], [], False
+        for (attr, line) in self._hunk_list:
+            if (attr != ' ') != changed and (old or new):
+                yield (old, new, changed)
+                old, new = [], []
+            changed = attr != ' '
+            if attr != '+':
+                old.append(line)
+            if attr != '-':
+                new.append(line)
+        if old or new:
+            yield (old, new, changed)
+
+    def _mdiff_by_run(self, inline=True):
+        """Returns same format as difflib._mdiff() but diffs each run of
+        changed lines separately, runs having long line go to diff_match_patch
+        and with inline False, lines are just paired without diffing.
+
+        Unlike difflib._mdiff() on whole hunk, common lines always stay common
+        as in the patch, thus a deleted or added line next to an identical
+        common line might be aligned differently; rows only match difflib when
+        the patch's alignment is the one difflib finds as well.
+        """
+        old_base = new_base = 0
+        for (old, new, changed) in self._get_runs():
+            if not changed:
+                rows = [((i + 1, line), (i + 1, line), False)
+                        for (i, line) in enumerate(old)]
+            elif not old or not new:
+                rows = self._mdiff_one_side(old, new)
+            elif not inline:
+                rows = self._paired_mdiff(old, new)
+            elif (max(map(len, old + new)) > self.LONG_LINE_LEN and
+                  Hunk._get_dmp() is not None):
+                dmp = Hunk._get_dmp()()
+                rows = self._paired_mdiff(
+                    old, new, lambda a, b: _dmp_markup(dmp, a, b))
+            else:
+                rows = self._difflib_mdiff(old, new)
+
+            for ((old_num, old_text), (new_num, new_text), flag) in rows:
+                if old_num:
+                    old_num += old_base
+                if new_num:
+                    new_num += new_base
+                yield ((old_num, old_text), (new_num, new_text), flag)
+
+            old_base += len(old)
+            new_base += len(new)
+
+    def _paired_mdiff(self, old, new, markup=None):
+        """Pairs old and new lines in order and marks changes in between with
+        markup(old line, new line) if given, returns same as difflib._mdiff()
+        """
+        for i in range(max(len(old), len(new))):
+            if i >= len(new):
+                yield ((i + 1, _mark_line('-', old[i])), ('', '\n'), True)
+            elif i >= len(old):
+                yield (('', '\n'), (i + 1, _mark_line('+', new[i])), True)
+            elif markup is None:
+                yield ((i + 1, old[i]), (i + 1, new[i]), True)
+            else:
+                old_text, new_text = markup(old[i], new[i])
+                yield ((i + 1, old_text), (i + 1, new_text), True)
 
     def _get_old_text(self):
-        return [line for (attr, line) in self._hunk_list if attr != '+']
+        return self._old_text
 
     def _get_new_text(self):
-        return [line for (attr, line) in self._hunk_list if attr != '-']
+        return self._new_text
 
     def is_completed(self):
-        old_completed = self._old_addr[1] == len(self._get_old_text())
-        new_completed = self._new_addr[1] == len(self._get_new_text())
+        old_completed = self._old_addr[1] == len(self._old_text)
+        new_completed = self._new_addr[1] == len(self._new_text)
         return old_completed and new_completed
 
 
 class UnifiedDiff(object):
 
+    _SVN_LOG_SEP_RE = re.compile(r'^-{72}$')
+    _BINARY_DIFFER_RE = re.compile(r'^Binary files .* differ$')
+    # Tolerant like is_hunk_meta(), fields may be separated by any whitespace,
+    # the '+' is not checked and the closing @@ is not required
+    _HUNK_META_RE = re.compile(
+        r'^[@#]{2}\s+-(\d+)(?:,(\d+))?\s+\S(\d+)(?:,(\d+))?(?=\s|$)')
+
     def __init__(self, headers, old_path, new_path, hunks):
         self._headers = headers
         self._old_path = old_path
@@ -247,21 +504,17 @@ class UnifiedDiff(object):
                 line.startswith('## -') and line.find(' ##') >= 8)
 
     def parse_hunk_meta(self, hunk_meta):
-        # @@ -3,7 +3,6 @@
-        a = hunk_meta.split()[1].split(',')   # -3 7
-        if len(a) > 1:
-            old_addr = (int(a[0][1:]), int(a[1]))
-        else:
-            # @@ -1 +1,2 @@
-            old_addr = (int(a[0][1:]), 1)
-
-        b = hunk_meta.split()[2].split(',')   # +3 6
-        if len(b) > 1:
-            new_addr = (int(b[0][1:]), int(b[1]))
-        else:
-            # @@ -0,0 +1 @@
-            new_addr = (int(b[0][1:]), 1)
+        """Returns tuple (old_addr, new_addr), each is tuple (start, offset),
+        offset might be omitted and defaults to 1, e.g. in '@@ -1 +1,2 @@'.
+        Raises ValueError if hunk_meta is malformed.
+        """
+        m = self._HUNK_META_RE.match(hunk_meta)
+        if not m:
+            raise ValueError('invalid hunk meta: %s' % hunk_meta)
 
+        old_start, old_offset, new_start, new_offset = m.groups()
+        old_addr = (int(old_start), int(old_offset or 1))
+        new_addr = (int(new_start), int(new_offset or 1))
         return (old_addr, new_addr)
 
     def parse_hunk_line(self, line):
@@ -271,11 +524,11 @@ class UnifiedDiff(object):
         """Exclude old path and header line from svn log --diff output, allow
         '----' likely to see in diff from yaml file
         """
-        return (line.startswith('-') and not self.is_old_path(line) and
-                not re.match(r'^-{72}$', line.rstrip()))
+        return (line.startswith('-') and not line.startswith('--- ') and
+                not self._SVN_LOG_SEP_RE.match(line.rstrip()))
 
     def is_new(self, line):
-        return line.startswith('+') and not self.is_new_path(line)
+        return line.startswith('+') and not line.startswith('+++ ')
 
     def is_common(self, line):
         return line.startswith(' ')
@@ -289,7 +542,7 @@ class UnifiedDiff(object):
         return line.startswith('Only in ')
 
     def is_binary_differ(self, line):
-        return re.match('^Binary files .* differ$', line.rstrip())
+        return self._BINARY_DIFFER_RE.match(line.rstrip())
 
 
 class PatchStream(object):
@@ -332,9 +585,9 @@ class PatchStream(object):
 
 
 class PatchStreamForwarder(object):
-    """A blocking stream forwarder use `select` and line buffered mode.  Feed
-    input stream to a diff format translator and read output stream from it.
-    Note input stream is non-seekable, and upstream has eaten some lines.
+    """A blocking stream forwarder, a background thread feeds input stream to
+    a diff format translator while output stream is read from it.  Note input
+    stream is non-seekable, and upstream has eaten some lines.
     """
     def __init__(self, istream, translator):
         assert isinstance(istream, PatchStream)
@@ -342,27 +595,40 @@ class PatchStreamForwarder(object):
         self._istream = iter(istream)
         self._in = translator.stdin
         self._out = translator.stdout
+        self._error = None  # error reading input stream, raised by __iter__
 
-    def _can_read(self, timeout=0):
-        return select.select([self._out.fileno()], [], [], timeout)[0]
+        pump = threading.Thread(target=self._forward)
+        pump.daemon = True
+        pump.start()
 
-    def _forward_line(self):
+    def _forward(self):
         try:
-            line = next(self._istream)
-            self._in.write(line)
-        except StopIteration:
-            self._in.close()
+            for line in self._istream:
+                try:
+                    self._in.write(line)
+                except (IOError, OSError):
+                    if sys.exc_info()[1].errno != errno.EPIPE:
+                        raise
+                    # Translator has gone, nothing to feed any more
+                    return
+        except Exception:
+            self._error = sys.exc_info()[1]
+        finally:
+            # Translator must see EOF whatever happened, otherwise reading its
+            # output blocks forever
+            try:
+                self._in.close()
+            except (IOError, OSError):
+                pass
 
     def __iter__(self):
         while True:
-            if self._can_read():
-                line = self._out.readline()
-                if line:
-                    yield line
-                else:
-                    return
-            elif not self._in.closed:
-                self._forward_line()
+            line = self._out.readline()
+            if not line:
+                break
+            yield line
+        if self._error is not None:
+            raise self._error
 
 
 class DiffParser(object):
@@ -382,10 +648,11 @@ class DiffParser(object):
             #
             self._type = 'context'
             try:
-                # Use line buffered mode so that to readline() in block mode
+                # Input is fed from another thread, so the pipes can be fully
+                # buffered
                 self._translator = subprocess.Popen(
                     ['filterdiff', '--format=unified'], stdin=subprocess.PIPE,
-                    stdout=subprocess.PIPE, bufsize=1)
+                    stdout=subprocess.PIPE, bufsize=-1)
             except OSError:
                 raise SystemExit('*** Context diff support depends on '
                                  'filterdiff')
@@ -408,68 +675,42 @@ class DiffParser(object):
 
     def get_diff_generator(self):
         """parse all diff lines, construct a list of UnifiedDiff objects"""
-        diff = UnifiedDiff([], None, None, [])
-        headers = []
+        self._diff = UnifiedDiff([], None, None, [])
+        self._headers = []
+
+        # Most kinds of lines are determined by their first 4 chars, and the
+        # rest, i.e. hunk lines, by the first char; pick the handler by them.
+        # Each handler returns completely constructed diffs if any.  All other
+        # non-recognized lines are considered as headers or hunk headers
+        # respectively
+        #
+        prefix_handlers = {
+            '--- ': self._handle_old_path,
+            '+++ ': self._handle_new_path,
+            '@@ -': self._handle_hunk_meta,
+            '## -': self._handle_hunk_meta,
+            '\\ No': self._handle_eof,
+            'Only': self._handle_only_in_dir,
+            'Bina': self._handle_binary_differ,
+        }
+        char_handlers = {
+            '-': self._handle_old,
+            '+': self._handle_new,
+            ' ': self._handle_common,
+        }
+        handle_header = self._handle_header
 
         for line in self._stream:
             line = decode(line)
-
-            if diff.is_old_path(line):
-                # This is a new diff when current hunk is not yet genreated or
-                # is completed.  We yield previous diff if exists and construct
-                # a new one for this case.  Otherwise it's acutally an 'old'
-                # line starts with '--- '.
-                #
-                if (not diff._hunks or diff._hunks[-1].is_completed()):
-                    if diff._old_path and diff._new_path and diff._hunks:
-                        yield diff
-                    diff = UnifiedDiff(headers, line, None, [])
-                    headers = []
-                else:
-                    diff._hunks[-1].append(diff.parse_hunk_line(line))
-
-            elif diff.is_new_path(line) and diff._old_path:
-                if not diff._new_path:
-                    diff._new_path = line
-                else:
-                    diff._hunks[-1].append(diff.parse_hunk_line(line))
-
-            elif diff.is_hunk_meta(line):
-                hunk_meta = line
-                try:
-                    old_addr, new_addr = diff.parse_hunk_meta(hunk_meta)
-                except (IndexError, ValueError):
-                    raise RuntimeError('invalid hunk meta: %s' % hunk_meta)
-                hunk = Hunk(headers, hunk_meta, old_addr, new_addr)
-                headers = []
-                diff._hunks.append(hunk)
-
-            elif diff._hunks and not headers and (diff.is_old(line) or
-                                                  diff.is_new(line) or
-                                                  diff.is_common(line)):
-                diff._hunks[-1].append(diff.parse_hunk_line(line))
-
-            elif diff.is_eof(line):
-                # ignore
-                pass
-
-            elif diff.is_only_in_dir(line) or diff.is_binary_differ(line):
-                # 'Only in foo:' and 'Binary files ... differ' are considered
-                # as separate diffs, so yield current diff, then this line
-                #
-                if diff._old_path and diff._new_path and diff._hunks:
-                    # Current diff is comppletely constructed
+            handler = (prefix_handlers.get(line[:4]) or
+                       char_handlers.get(line[:1], handle_header))
+            done = handler(line)
+            if done:
+                for diff in done:
                     yield diff
-                headers.append(line)
-                yield UnifiedDiff(headers, '', '', [])
-                headers = []
-                diff = UnifiedDiff([], None, None, [])
 
-            else:
-                # All other non-recognized lines are considered as headers or
-                # hunk headers respectively
-                #
-                headers.append(line)
+        diff = self._diff
+        headers = self._headers
 
         # Validate and yield the last patch set if it is not yielded yet
         if diff._old_path:
@@ -485,14 +726,119 @@ class DiffParser(object):
             #
             yield UnifiedDiff(headers, '', '', [])
 
+    def _in_hunk(self):
+        """Whether a hunk line is expected"""
+        return self._diff._hunks and not self._headers
+
+    def _handle_header(self, line):
+        self._headers.append(line)
+
+    def _handle_old_path(self, line):
+        # This is a new diff when current hunk is not yet genreated or is
+        # completed.  We yield previous diff if exists and construct a new one
+        # for this case.  Otherwise it's acutally an 'old' line starts with
+        # '--- '.
+        #
+        diff = self._diff
+        if (not diff._hunks or diff._hunks[-1].is_completed()):
+            self._diff = UnifiedDiff(self._headers, line, None, [])
+            self._headers = []
+            if diff._old_path and diff._new_path and diff._hunks:
+                return (diff,)
+        else:
+            diff._hunks[-1].append(diff.parse_hunk_line(line))
+
+    def _handle_new_path(self, line):
+        diff = self._diff
+        if not diff._old_path:
+            self._headers.append(line)
+        elif not diff._new_path:
+            diff._new_path = line
+        else:
+            diff._hunks[-1].append(diff.parse_hunk_line(line))
+
+    def _handle_old(self, line):
+        if self._in_hunk() and self._diff.is_old(line):
+            self._diff._hunks[-1].append(self._diff.parse_hunk_line(line))
+        else:
+            self._headers.append(line)
+
+    def _handle_new(self, line):
+        if self._in_hunk() and self._diff.is_new(line):
+            self._diff._hunks[-1].append(self._diff.parse_hunk_line(line))
+        else:
+            self._headers.append(line)
+
+    def _handle_hunk_meta(self, line):
+        diff = self._diff
+        if not diff.is_hunk_meta(line):
+            self._headers.append(line)
+            return
+
+        try:
+            old_addr, new_addr = diff.parse_hunk_meta(line)
+        except (IndexError, ValueError):
+            raise RuntimeError('invalid hunk meta: %s' % line)
+        diff._hunks.append(Hunk(self._headers, line, old_addr, new_addr))
+        self._headers = []
+
+    def _handle_common(self, line):
+        if self._in_hunk():
+            self._diff._hunks[-1].append(self._diff.parse_hunk_line(line))
+        else:
+            self._headers.append(line)
+
+    def _handle_eof(self, line):
+        # '\ No newline at end of file' is ignored
+        if not self._diff.is_eof(line):
+            self._headers.append(line)
+
+    def _handle_only_in_dir(self, line):
+        if self._diff.is_only_in_dir(line):
+            return self._handle_standalone(line)
+        self._headers.append(line)
+
+    def _handle_binary_differ(self, line):
+        if self._diff.is_binary_differ(line):
+            return self._handle_standalone(line)
+        self._headers.append(line)
+
+    def _handle_standalone(self, line):
+        """'Only in foo:' and 'Binary files ... differ' are considered as
+        separate diffs, so return current diff, then this line
+        """
+        done = []
+        diff = self._diff
+        if diff._old_path and diff._new_path and diff._hunks:
+            # Current diff is comppletely constructed
+            done.append(diff)
+        self._headers.append(line)
+        done.append(UnifiedDiff(self._headers, '', '', []))
+        self._headers = []
+        self._diff = UnifiedDiff([], None, None, [])
+        return done
+
 
 class DiffMarker(object):
 
-    def __init__(self, side_by_side=False, width=0, tab_width=8, wrap=False):
+    def __init__(self, side_by_side=False, width=0, tab_width=8, wrap=False,
+                 inline=True):
         self._side_by_side = side_by_side
         self._width = width
         self._tab_width = tab_width
         self._wrap = wrap
+        self._inline = inline
+
+        # Colors used for whole lines are looked up once here instead of with
+        # every line
+        self._reset = COLORS['reset']
+        self._header_color = COLORS['cyan']
+        self._path_color = COLORS['yellow']
+        self._hunk_header_color = COLORS['lightcyan']
+        self._hunk_meta_color = COLORS['lightblue']
+        self._old_color = COLORS['lightred']
+        self._new_color = COLORS['green']
+        self._wrap_char = colorize('>', 'lightmagenta')
 
     def markup(self, diff):
         """Returns a generator"""
@@ -515,7 +861,7 @@ class DiffMarker(object):
             for hunk_header in hunk._hunk_headers:
                 yield self._markup_hunk_header(hunk_header)
             yield self._markup_hunk_meta(hunk._hunk_meta)
-            for old, new, changed in hunk.mdiff():
+            for old, new, changed in hunk.mdiff(self._inline):
                 if changed:
                     if not old[0]:
                         # The '+' char after \x00 is kept
@@ -539,42 +885,23 @@ class DiffMarker(object):
     def _markup_side_by_side(self, diff):
         """Returns a generator"""
 
+        tab = ' ' * self._tab_width
+
         def _normalize(line):
-            return (line
-                    .replace('\t', ' ' * self._tab_width)
-                    .replace('\n', '')
-                    .replace('\r', ''))
+            return line.replace('\t', tab).replace('\n', '').replace('\r', '')
 
         def _fit_with_marker_mix(text, base_color):
             """Wrap input text which contains mdiff tags, markup at the
             meantime
             """
-            out = [COLORS[base_color]]
-            tag_re = re.compile(r'\x00[+^-]|\x01')
-
-            while text:
-                if text.startswith('\x00-'):    # del
-                    out.append(COLORS['reverse'] + COLORS[base_color])
-                    text = text[2:]
-                elif text.startswith('\x00+'):  # add
-                    out.append(COLORS['reverse'] + COLORS[base_color])
-                    text = text[2:]
-                elif text.startswith('\x00^'):  # change
-                    out.append(COLORS['underline'] + COLORS[base_color])
-                    text = text[2:]
-                elif text.startswith('\x01'):   # reset
-                    if len(text) > 1:
-                        out.append(COLORS['reset'] + COLORS[base_color])
-                    text = text[1:]
-                else:
-                    # FIXME: utf-8 wchar might break the rule here, e.g.
-                    # u'\u554a' takes double width of a single letter, also
-                    # this depends on your terminal font.  I guess audience of
-                    # this tool never put that kind of symbol in their code :-)
-                    #
-                    out.append(text[0])
-                    text = text[1:]
+            # A trailing reset marker is covered by the final reset
+            if text.endswith('\x01'):
+                text = text[:-1]
 
+            codes = marker_codes(base_color)
+            out = [COLORS[base_color]]
+            for token in _MARKER_RE.split(text):
+                out.append(codes.get(token, token))
             out.append(COLORS['reset'])
 
             return ''.join(out)
@@ -603,11 +930,11 @@ class DiffMarker(object):
                 # If terminal detection failed, set back to default
                 width = 80
 
-        # Setup lineno and line format
-        left_num_fmt = colorize('%%(left_num)%ds' % num_width, 'yellow')
-        right_num_fmt = colorize('%%(right_num)%ds' % num_width, 'yellow')
-        line_fmt = (left_num_fmt + ' %(left)s ' + COLORS['reset'] +
-                    right_num_fmt + ' %(right)s\n')
+        # Setup lineno and line format, number width is fixed for the whole
+        # diff so bake it in, positional arguments are cheaper than a dict
+        num_fmt = colorize('%%%ds' % num_width, 'yellow')
+        line_fmt = (num_fmt + ' %s ' + COLORS['reset'] +
+                    num_fmt + ' %s\n')
 
         # yield header, old path and new path
         for line in diff._headers:
@@ -620,7 +947,7 @@ class DiffMarker(object):
             for hunk_header in hunk._hunk_headers:
                 yield self._markup_hunk_header(hunk_header)
             yield self._markup_hunk_meta(hunk._hunk_meta)
-            for old, new, changed in hunk.mdiff():
+            for old, new, changed in hunk.mdiff(self._inline):
                 if old[0]:
                     left_num = str(hunk._old_addr[0] + int(old[0]) - 1)
                 else:
@@ -671,12 +998,7 @@ class DiffMarker(object):
                         if llen < width:
                             lcur = '%s%*s' % (lcur, width - llen, '')
 
-                        yield line_fmt % {
-                            'left_num': lncur,
-                            'left': lcur,
-                            'right_num': rncur,
-                            'right': rcur
-                        }
+                        yield line_fmt % (lncur, lcur, rncur, rcur)
 
                         # Clean line numbers for further iterations
                         lncur = ''
@@ -684,50 +1006,39 @@ class DiffMarker(object):
                 else:
                     # Don't need to wrap long lines; instead, a trailing '>'
                     # char needs to be appended.
-                    wrap_char = colorize('>', 'lightmagenta')
-                    left = strtrim(left, width, wrap_char, len(right) > 0)
-                    right = strtrim(right, width, wrap_char, False)
+                    left = strtrim(left, width, self._wrap_char,
+                                   len(right) > 0)
+                    right = strtrim(right, width, self._wrap_char, False)
 
-                    yield line_fmt % {
-                        'left_num': left_num,
-                        'left': left,
-                        'right_num': right_num,
-                        'right': right
-                    }
+                    yield line_fmt % (left_num, left, right_num, right)
 
     def _markup_header(self, line):
-        return colorize(line, 'cyan')
+        return self._header_color + line + self._reset
 
     def _markup_old_path(self, line):
-        return colorize(line, 'yellow')
+        return self._path_color + line + self._reset
 
     def _markup_new_path(self, line):
-        return colorize(line, 'yellow')
+        return self._path_color + line + self._reset
 
     def _markup_hunk_header(self, line):
-        return colorize(line, 'lightcyan')
+        return self._hunk_header_color + line + self._reset
 
     def _markup_hunk_meta(self, line):
-        return colorize(line, 'lightblue')
+        return self._hunk_meta_color + line + self._reset
 
     def _markup_common(self, line):
-        return colorize(line, 'reset')
+        return self._reset + line + self._reset
 
     def _markup_old(self, line):
-        return colorize(line, 'lightred')
+        return self._old_color + line + self._reset
 
     def _markup_new(self, line):
-        return colorize(line, 'green')
+        return self._new_color + line + self._reset
 
     def _markup_mix(self, line, base_color):
-        del_code = COLORS['reverse'] + COLORS[base_color]
-        add_code = COLORS['reverse'] + COLORS[base_color]
-        chg_code = COLORS['underline'] + COLORS[base_color]
-        rst_code = COLORS['reset'] + COLORS[base_color]
-        line = line.replace('\x00-', del_code)
-        line = line.replace('\x00+', add_code)
-        line = line.replace('\x00^', chg_code)
-        line = line.replace('\x01', rst_code)
+        codes = marker_codes(base_color)
+        line = _MARKER_RE.sub(lambda m: codes[m.group()], line)
         return colorize(line, base_color)
 
 
@@ -736,8 +1047,8 @@ def markup_to_pager(stream, opts):
 
     Note: have to create pager Popen object before the translator Popen object
     in PatchStreamForwarder, otherwise the `stdin=subprocess.PIPE` would cause
-    trouble to the translator pipe (select() never see EOF after input stream
-    ended), most likely python bug 12607 (http://bugs.python.org/issue12607)
+    trouble to the translator pipe (never see EOF after input stream ended),
+    most likely python bug 12607 (http://bugs.python.org/issue12607)
     which was fixed in python 2.7.3.
 
     See issue #30 (https://github.com/ymattw/ydiff/issues/30) for more
@@ -750,13 +1061,24 @@ def markup_to_pager(stream, opts):
     pager = subprocess.Popen(
         pager_cmd, stdin=subprocess.PIPE, stdout=sys.stdout)
 
+    # Feed pager in chunks instead of writing line by line, and encode each
+    # chunk as a whole rather than every markup line on its own
+    buf = []
+    buf_len = 0
+    marker = DiffMarker(side_by_side=opts.side_by_side, width=opts.width,
+                        tab_width=opts.tab_width, wrap=opts.wrap,
+                        inline=opts.inline)
     diffs = DiffParser(stream).get_diff_generator()
     for diff in diffs:
-        marker = DiffMarker(side_by_side=opts.side_by_side, width=opts.width,
-                            tab_width=opts.tab_width, wrap=opts.wrap)
         color_diff = marker.markup(diff)
         for line in color_diff:
-            pager.stdin.write(line.encode('utf-8'))
+            buf.append(line)
+            buf_len += len(line)
+            if buf_len >= IO_CHUNK_SIZE:
+                pager.stdin.write(''.join(buf).encode('utf-8'))
+                buf = []
+                buf_len = 0
+    pager.stdin.write(''.join(buf).encode('utf-8'))
 
     pager.stdin.close()
     pager.wait()
@@ -772,17 +1094,16 @@ def check_command_status(arguments):
 
 
 def decode(line):
-    """Decode UTF-8 if necessary."""
+    """Decode UTF-8 if necessary, fall back to latin1 which accepts any
+    byte sequence.  Called for each diff line, so keep it cheap.
+    """
     if isinstance(line, unicode):
         return line
 
-    for encoding in ['utf-8', 'latin1']:
-        try:
-            return line.decode(encoding)
-        except UnicodeDecodeError:
-            pass
-
-    return '*** ydiff: undecodable bytes ***\n'
+    try:
+        return line.decode('utf-8')
+    except UnicodeDecodeError:
+        return line.decode('latin1')
 
 
 def terminal_size():
@@ -802,12 +1123,33 @@ def terminal_size():
     return width, height
 
 
-def main():
-    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
-    signal.signal(signal.SIGINT, signal.SIG_DFL)
+# Option parser, see _build_parser()
+_PARSER = None
+
+
+class _DefaultOptions(object):
+    """Option values of an empty command line, saves constructing the parser
+    in the common case of piping in a diff without any option
+    """
+    side_by_side = None
+    width = 80
+    log = None
+    color = 'auto'
+    tab_width = 8
+    wrap = None
+    inline = True
+
 
-    from optparse import (OptionParser, BadOptionError, AmbiguousOptionError,
-                          OptionGroup)
+_DEFAULT_OPTS = _DefaultOptions()
+
+
+def _build_parser():
+    """Returns the command line option parser, constructed on first call"""
+    global _PARSER
+    if _PARSER is not None:
+        return _PARSER
+
+    from optparse import OptionParser, BadOptionError, AmbiguousOptionError
 
     class PassThroughOptionParser(OptionParser):
         """Stop parsing on first unknown option (e.g. --cached, -U10) and pass
@@ -825,11 +1167,19 @@ def main():
             except (BadOptionError, AmbiguousOptionError):
                 parsed_num = len(rargs) - len(right) - 1
                 rargs.insert(parsed_num, '--')
-            OptionParser._process_args(self, largs, rargs, values)
+                OptionParser._process_args(self, largs, rargs, values)
+            else:
+                # All known, no need to parse again
+                largs[:] = left
+                rargs[:] = right
 
     usage = """%prog [options] [file|dir ...]"""
+    epilog = ('Note: option parser will stop on first unknown option and pass '
+              'them down to underneath revision control. Environment '
+              'variable YDIFF_OPTIONS may be used to specify default options '
+              'that will be placed at the beginning of the argument list.')
     parser = PassThroughOptionParser(
-        usage=usage, description=META_INFO['description'],
+        usage=usage, description=META_INFO['description'], epilog=epilog,
         version='%%prog %s' % META_INFO['version'])
     parser.add_option(
         '-s', '--side-by-side', action='store_true',
@@ -850,68 +1200,74 @@ def main():
     parser.add_option(
         '', '--wrap', action='store_true',
         help='wrap long lines in side-by-side view')
+    parser.add_option(
+        '', '--no-inline-diff', action='store_false', dest='inline',
+        default=True,
+        help='do not highlight changes within lines, faster on large diffs')
+
+    _PARSER = parser
+    return parser
 
-    # Hack: use OptionGroup text for extra help message after option list
-    option_group = OptionGroup(
-        parser, 'Note', ('Option parser will stop on first unknown option '
-                         'and pass them down to underneath revision control. '
-                         'Environment variable YDIFF_OPTIONS may be used to '
-                         'specify default options that will be placed at the '
-                         'beginning of the argument list.'))
-    parser.add_option_group(option_group)
+
+def main():
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
 
     # Place possible options defined in YDIFF_OPTIONS at the beginning of argv
-    ydiff_opts = [x for x in os.getenv('YDIFF_OPTIONS', '').split(' ') if x]
+    ydiff_opts = os.environ.get('YDIFF_OPTIONS', '').split()
 
     # TODO: Deprecate CDIFF_OPTIONS. Fall back to it and warn (for now).
     if not ydiff_opts:
-        cdiff_opts = [x for x in os.getenv('CDIFF_OPTIONS', '').split(' ')
-                      if x]
+        cdiff_opts = os.environ.get('CDIFF_OPTIONS', '').split()
         if cdiff_opts:
-            sys.stderr.write('*** CDIFF_OPTIONS will be depreated soon, '
-                             'please use YDIFF_OPTIONS instead\n')
+            sys.stderr.write(_ERR_CDIFF_DEPRECATED)
             ydiff_opts = cdiff_opts
 
-    opts, args = parser.parse_args(ydiff_opts + sys.argv[1:])
+    argv = ydiff_opts + sys.argv[1:]
+    if argv:
+        opts, args = _build_parser().parse_args(argv)
+    else:
+        opts, args = _DEFAULT_OPTS, []
+
+    # Byte streams of stdin and stdout, python 3 wraps them as text
+    byte_input = getattr(sys.stdin, 'buffer', sys.stdin)
+    byte_output = getattr(sys.stdout, 'buffer', sys.stdout)
+    want_color = (opts.color == 'always' or
+                  (opts.color == 'auto' and sys.stdout.isatty()))
 
     if not sys.stdin.isatty():
-        diff_hdl = (sys.stdin.buffer if hasattr(sys.stdin, 'buffer')
-                    else sys.stdin)
+        diff_hdl = byte_input
     else:
         vcs_name = revision_control_probe()
         if vcs_name is None:
-            supported_vcs = ', '.join(sorted(VCS_INFO.keys()))
-            sys.stderr.write('*** Not in a supported workspace, supported are:'
-                             ' %s\n' % supported_vcs)
+            sys.stderr.write(_ERR_NOT_IN_WORKSPACE)
             return 1
 
         if opts.log:
             diff_hdl = revision_control_log(vcs_name, args)
             if diff_hdl is None:
-                sys.stderr.write('*** %s does not support log command.\n' %
-                                 vcs_name)
+                sys.stderr.write(_ERR_NO_LOG_FMT % vcs_name)
                 return 1
         else:
             # 'diff' is a must have feature.
             diff_hdl = revision_control_diff(vcs_name, args)
 
-    stream = PatchStream(diff_hdl)
+    if want_color:
+        stream = PatchStream(diff_hdl)
 
-    # Don't let empty diff pass thru
-    if stream.is_empty():
-        return 0
-
-    if (opts.color == 'always' or
-            (opts.color == 'auto' and sys.stdout.isatty())):
-        markup_to_pager(stream, opts)
+        # Don't let empty diff pass thru
+        if not stream.is_empty():
+            markup_to_pager(stream, opts)
     else:
-        # pipe out stream untouched to make sure it is still a patch
-        byte_output = (sys.stdout.buffer if hasattr(sys.stdout, 'buffer')
-                       else sys.stdout)
-        for line in stream:
-            byte_output.write(line)
+        # pipe out stream untouched to make sure it is still a patch, nothing
+        # is written for empty diff.  No need to split lines, just copy chunks
+        while True:
+            data = diff_hdl.read(IO_CHUNK_SIZE)
+            if not data:
+                break
+            byte_output.write(data)
 
-    if diff_hdl is not sys.stdin:
+    if diff_hdl is not byte_input:
         diff_hdl.close()
 
     return 0